@@ -1,8 +1,20 @@
-from .inference import run_inference_on_excel
-from .test_single_coordinate import test_single_coordinate
+import importlib
 
 # Usage: 
 #   from pipeline_code import run_inference_on_excel, test_single_coordinate
 #   run_inference_on_excel("input.csv", "solar_model.pt", "predictions")
 
 # No main function or CLI interface needed as the module now exposes functions for import
+
+# Entry points are imported on first access so that importing this module does not
+# pull in ultralytics/torch/pandas until they are actually needed.
+_LAZY_ATTRS = {
+    "run_inference_on_excel": ".inference",
+    "test_single_coordinate": ".test_single_coordinate",
+}
+
+def __getattr__(name):
+    if name in _LAZY_ATTRS:
+        module = importlib.import_module(_LAZY_ATTRS[name], __package__)
+        return getattr(module, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
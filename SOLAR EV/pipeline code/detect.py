@@ -1,39 +1,138 @@
-from ultralytics import YOLO
+from pathlib import Path
 import numpy as np
 import warnings
 warnings.filterwarnings('ignore')
 
 _model = None
+_predict_kwargs = {"device": "cpu"}  # Device/precision arguments shared by every predict call
+_max_batch = None  # Most images per predict call the loaded TensorRT engine accepts; None for no limit
+_models = {}  # (model_path, device, half, tensorrt) -> (loaded, warmed-up YOLO model, max batch)
 
-def load_model(model_path="solar_model.pt", device="cpu"):
-    """Load YOLO model from path."""
-    global _model
+def load_model(model_path="solar_model.pt", device="cpu", half=None, tensorrt=False, batch=16):
+    """
+    Load YOLO model from path.
+    half: run inference in FP16; defaults to True on GPU devices.
+    tensorrt: on GPU, export the weights to a TensorRT .engine beside the .pt
+              (once) and load that instead. A .engine model_path is loaded directly.
+    batch: largest number of images passed to predict_on_pil_batch at once; exported
+           engines take any batch size up to this
+    """
+    global _model, _predict_kwargs, _max_batch
+    on_gpu = str(device) != "cpu"
+    if half is None:
+        half = on_gpu
+    
+    key = (str(Path(model_path).resolve()), str(device), half, tensorrt)
+    if key in _models:
+        _model, _max_batch = _models[key]
+        _predict_kwargs = _build_predict_kwargs(device, half)
+        return _model
+    
+    from ultralytics import YOLO  # Deferred: pulls in torch, which is slow to import
+    
+    model_path = str(model_path)
+    if tensorrt and on_gpu and not model_path.endswith('.engine'):
+        engine_path = Path(model_path).with_suffix('.engine')
+        if not engine_path.exists():
+            export_kwargs = _build_predict_kwargs(device, half)
+            # Dynamic batch so predict_on_pil_batch can send up to `batch` images per call
+            YOLO(model_path, verbose=False).export(format='engine', imgsz=640, batch=batch, dynamic=True,
+                                                   **export_kwargs)
+        model_path = str(engine_path)
+    
     _model = YOLO(model_path, verbose=False)
-    _model.to(device)
+    if not model_path.endswith('.engine'):
+        _model.to(device)  # TensorRT engines are bound to the device they were built on
+    _predict_kwargs = _build_predict_kwargs(device, half)
+    
+    # Warm up once so cuDNN autotuning and lazy initialisation happen outside the timed loop
+    _model.predict(np.zeros((640, 640, 3), dtype=np.uint8), imgsz=640, verbose=False, **_predict_kwargs)
+    _max_batch = _engine_batch_limit(_model) if model_path.endswith('.engine') else None
+    
+    _models[key] = (_model, _max_batch)
     return _model
 
+def _engine_batch_limit(model):
+    """
+    Images per predict call a loaded TensorRT engine accepts: its export batch, which is
+    the upper bound for dynamic engines and the only size a static engine takes
+    (e.g. a user-supplied batch-1 .engine).
+    """
+    return max(1, int(getattr(model.predictor.model, 'batch', 1)))
+
+def _build_predict_kwargs(device, half):
+    """
+    Device and precision arguments for predict/export.
+    The precision flag is only passed for FP16, under whichever name the installed
+    Ultralytics uses ('quantize' in newer releases warns on every call given 'half').
+    """
+    kwargs = {"device": device}
+    if half:
+        from ultralytics.cfg import DEFAULT_CFG_DICT
+        if "quantize" in DEFAULT_CFG_DICT:
+            kwargs["quantize"] = 16
+        else:
+            kwargs["half"] = True
+    return kwargs
+
+def unload_model():
+    """Drop the active model and every cached one (mainly for tests)."""
+    global _model, _max_batch
+    _model = None
+    _max_batch = None
+    _models.clear()
+
 def predict_on_pil(image_pil, conf_thresh=0.25, iou=0.45):
     """
     Run model inference on PIL image.
     Returns: list of detections (dicts with box, conf, cls, mask), raw results
+    Masks are torch tensors on the model's device.
     """
     global _model
     if _model is None:
         raise RuntimeError("Model not loaded. Call load_model() first.")
     
-    img_np = np.array(image_pil)[:, :, ::-1]  # Convert RGB to BGR
-    results = _model.predict(img_np, conf=conf_thresh, iou=iou, verbose=False, imgsz=image_pil.size[0])
+    # Ultralytics accepts PIL directly and does the RGB->BGR conversion itself
+    results = _model.predict(image_pil, conf=conf_thresh, iou=iou, verbose=False, imgsz=image_pil.size[0],
+                             **_predict_kwargs)
     res = results[0]
+    return _detections_from_result(res), res
+
+def predict_on_pil_batch(images, conf_thresh=0.25, iou=0.45, imgsz=640):
+    """
+    Run model inference on a list of PIL images in a single predict call
+    (split into several when a TensorRT engine takes fewer images at once).
+    Returns: list of (detections, raw result) tuples, one per input image
+    """
+    global _model
+    if _model is None:
+        raise RuntimeError("Model not loaded. Call load_model() first.")
+    images = list(images)
+    if not images:
+        return []
+    
+    step = _max_batch or len(images)
+    results = []
+    for start in range(0, len(images), step):
+        results.extend(_model.predict(images[start:start + step], conf=conf_thresh, iou=iou, verbose=False,
+                                      imgsz=imgsz, **_predict_kwargs))
+    return [(_detections_from_result(res), res) for res in results]
+
+def _detections_from_result(res):
+    """Convert a single Ultralytics result into a list of detection dicts."""
     dets = []
     boxes = res.boxes
+    if boxes is None or len(boxes) == 0:
+        return dets
+    
+    # One device->host copy per field instead of one sync per box
+    xyxy = boxes.xyxy.cpu().numpy()
+    confs = boxes.conf.cpu().numpy()
+    clss = boxes.cls.cpu().numpy().astype(int)
+    masks = res.masks.data if getattr(res, 'masks', None) is not None else None  # Left on the model's device for quantify
     
-    for i, box in enumerate(boxes):
-        x1, y1, x2, y2 = box.xyxy[0].tolist()
-        conf = float(box.conf[0])
-        cls = int(box.cls[0])
-        mask = None
-        if hasattr(res, 'masks') and res.masks is not None:
-            mask = res.masks.data[i].cpu().numpy()
-        dets.append({"box": [x1, y1, x2, y2], "conf": conf, "cls": cls, "mask": mask})
+    for i in range(len(xyxy)):
+        mask = masks[i] if masks is not None else None
+        dets.append({"box": xyxy[i].tolist(), "conf": float(confs[i]), "cls": int(clss[i]), "mask": mask})
     
-    return dets, res
+    return dets
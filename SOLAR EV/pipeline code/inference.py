@@ -1,13 +1,26 @@
 import os
-import json
-import pandas as pd
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 from pathlib import Path
 from .fetch_image import fetch_for_coordinate
-from .detect import load_model, predict_on_pil
+from .detect import load_model, predict_on_pil, predict_on_pil_batch
 from .quantify import compute_selected_panel_area
 from .qc import qc_decision
-from .utils import save_overlay
+from .utils import save_overlay, prune_tile_cache, write_json
+
+# Number of rows sent to the model in a single predict call
+BATCH_SIZE = 16
+# Threads downloading images ahead of inference
+FETCH_WORKERS = 8
+# Threads quantifying and saving rows after inference
+SAVE_WORKERS = 2
+# Maximum rows buffered between pipeline stages
+QUEUE_SIZE = 16
+# CSVs larger than this are streamed in chunks instead of loaded whole
+STREAM_CSV_BYTES = 50 * 1024 * 1024
+CSV_CHUNK_ROWS = 4096
 
 def process_row(sample_id, lat, lon, model, out_folder, buffer_sqft_primary=1200, buffer_sqft_secondary=2400):
     """
@@ -16,9 +29,62 @@ def process_row(sample_id, lat, lon, model, out_folder, buffer_sqft_primary=1200
     """
     img, metadata, radius_m = fetch_for_coordinate(lat, lon, buffer_sqft_primary, size=640)
     detections, raw = predict_on_pil(img)
-    qc_status, reasons = qc_decision(img, detections)
+    return finish_row(sample_id, lat, lon, img, metadata, radius_m, detections, out_folder,
+                      buffer_sqft_primary, buffer_sqft_secondary)
+
+def finish_row(sample_id, lat, lon, img, metadata, radius_m, detections, out_folder,
+               buffer_sqft_primary=1200, buffer_sqft_secondary=2400):
+    """
+    Finish a location whose primary image has already been run through the model.
+    Falls back to the secondary buffer when the primary image has no detections
+    but otherwise passes QC.
+    Returns record dict with results.
+    """
+    needs_secondary, qc = _needs_secondary(img, detections)
+    primary = (img, metadata, radius_m, detections, qc)
+    secondary = None
+    if needs_secondary:
+        # Try secondary buffer
+        img2, metadata2, radius_m2 = fetch_for_coordinate(lat, lon, buffer_sqft_secondary, size=640)
+        detections2, raw2 = predict_on_pil(img2)
+        secondary = (img2, metadata2, radius_m2, detections2, None)
+    
+    img, metadata, radius_m, detections, qc, chosen_buffer = _choose_result(
+        primary, secondary, buffer_sqft_primary, buffer_sqft_secondary)
+    return save_row(sample_id, lat, lon, img, metadata, radius_m, detections,
+                    chosen_buffer, out_folder, qc=qc)
+
+def _choose_result(primary, secondary, buffer_sqft_primary, buffer_sqft_secondary):
+    """
+    Pick which image to save for a location.
+    primary and secondary are (img, metadata, radius_m, detections, qc), where qc is the
+    (qc_status, reasons) already computed for that image or None; secondary is None
+    when no secondary image was fetched. The secondary image is only used if it has detections.
+    Returns (img, metadata, radius_m, detections, qc, chosen_buffer).
+    """
+    if secondary is not None and secondary[3]:
+        return (*secondary, buffer_sqft_secondary)
+    return (*primary, buffer_sqft_primary)
+
+def _needs_secondary(img, detections):
+    """
+    Check whether the primary image is usable but had no detections.
+    A refetch of the same spot would not fix low resolution, darkness or cloud/shadow.
+    Returns: needs_secondary, qc ((qc_status, reasons) if QC was run, else None)
+    """
+    if detections:
+        return False, None
+    qc = qc_decision(img, detections)
+    return qc[1] == ["no_detection"], qc
+
+def save_row(sample_id, lat, lon, img, metadata, radius_m, detections, chosen_buffer, out_folder, qc=None):
+    """
+    Quantify, QC and save the chosen image for a location: writes overlay and per-sample JSON.
+    qc: (qc_status, reasons) if already computed for this image
+    Returns record dict with results.
+    """
+    qc_status, reasons = qc if qc is not None else qc_decision(img, detections)
     
-    chosen_buffer = buffer_sqft_primary
     area_m2 = 0.0
     confidence = 0.0
     bbox_or_mask = None
@@ -26,25 +92,12 @@ def process_row(sample_id, lat, lon, model, out_folder, buffer_sqft_primary=1200
     
     if detections:
         area_m2, mask_pixels, mask = compute_selected_panel_area(detections, img.size, radius_m)
-        confidence = max([d["conf"] for d in detections]) if detections else 0.0
+        confidence = max([d["conf"] for d in detections])
         bbox_or_mask = "mask" if mask is not None else "bbox"
-    else:
-        # Try secondary buffer
-        img2, metadata2, radius_m2 = fetch_for_coordinate(lat, lon, buffer_sqft_secondary, size=640)
-        detections2, raw2 = predict_on_pil(img2)
-        if detections2:
-            img = img2
-            metadata = metadata2
-            radius_m = radius_m2
-            chosen_buffer = buffer_sqft_secondary
-            area_m2, mask_pixels, mask = compute_selected_panel_area(detections2, img.size, radius_m)
-            confidence = max([d["conf"] for d in detections2])
-            bbox_or_mask = "mask" if mask is not None else "bbox"
-            qc_status, reasons = qc_decision(img, detections2)
     
     # Save overlay
-    all_masks = [d.get("mask") for d in (detections if detections else [])]
-    all_boxes = [d["box"] for d in (detections if detections else [])]
+    all_masks = [d.get("mask") for d in detections]
+    all_boxes = [d["box"] for d in detections]
     out_overlay = os.path.join(out_folder, f"{sample_id}_overlay.png")
     
     try:
@@ -67,29 +120,209 @@ def process_row(sample_id, lat, lon, model, out_folder, buffer_sqft_primary=1200
         "image_metadata": metadata
     }
     
-    # Save JSON
-    with open(os.path.join(out_folder, f"{sample_id}.json"), "w") as f:
-        json.dump(record, f, indent=2)
+    # Save JSON (runs on a save worker during batch runs, off the inference thread)
+    write_json(os.path.join(out_folder, f"{sample_id}.json"), record)
     
     return record
 
-def run_inference_on_excel(excel_path, model_path, output_folder):
+def _error_record(sample_id, lat, lon, error):
+    """
+    Build the record stored for a row that failed to process.
+    Values that are not numbers (e.g. a blank or text sample_id) are kept as text,
+    so a bad row still gets a record instead of stopping the save worker.
+    """
+    try:
+        sample_id, lat, lon = int(sample_id), float(lat), float(lon)
+    except (TypeError, ValueError):
+        sample_id, lat, lon = str(sample_id), str(lat), str(lon)
+    return {
+        "sample_id": sample_id,
+        "lat": lat,
+        "lon": lon,
+        "error": str(error)
+    }
+
+def _put(q, item, stop):
+    """Put item on a bounded queue, giving up if the pipeline is shutting down."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _fetch_job(fetch_q, stop, kind, pos, sample_id, lat, lon, buffer_sqft):
+    """Fetch stage: download one image and hand it to the inference stage."""
+    if stop.is_set():
+        return
+    try:
+        fetched = fetch_for_coordinate(lat, lon, buffer_sqft, size=640)
+        error = None
+    except Exception as e:
+        fetched, error = None, e
+    _put(fetch_q, (kind, pos, sample_id, lat, lon, fetched, error), stop)
+
+def _produce(rows, fetch_pool, fetch_q, slots, stop, buffer_sqft):
+    """Submit a primary fetch for every row, keeping at most QUEUE_SIZE rows in flight."""
+    count = 0
+    error = None
+    try:
+        for pos, (sample_id, lat, lon) in enumerate(rows):
+            while not slots.acquire(timeout=0.5):
+                if stop.is_set():
+                    return
+            fetch_pool.submit(_fetch_job, fetch_q, stop, "primary", pos, sample_id, lat, lon, buffer_sqft)
+            count += 1
+    except Exception as e:
+        error = e
+    finally:
+        # Tell the inference stage how many rows to wait for, and why reading stopped early
+        _put(fetch_q, ("done", count, None, None, None, None, error), stop)
+
+def _save_worker(save_q, records, out_folder):
+    """Save stage: quantify, QC and write outputs until a None sentinel arrives."""
+    while True:
+        item = save_q.get()
+        if item is None:
+            return
+        pos, sample_id, lat, lon, img, metadata, radius_m, detections, qc, chosen_buffer = item
+        try:
+            records[pos] = save_row(sample_id, lat, lon, img, metadata, radius_m, detections,
+                                    chosen_buffer, out_folder, qc=qc)
+        except Exception as e:
+            print(f"  ERROR: {e}")
+            records[pos] = _error_record(sample_id, lat, lon, e)
+
+def run_pipeline(rows, output_folder, total=None, buffer_sqft_primary=1200, buffer_sqft_secondary=2400):
+    """
+    Run fetch -> inference -> save as concurrent stages over (sample_id, lat, lon) rows.
+    Fetching and saving run on thread pools; model calls stay on the calling thread
+    since Ultralytics predict is not thread-safe. Call load_model() first.
+    Returns: list of records in input order
+    Raises RuntimeError if reading rows fails; rows read before that are still saved.
+    """
+    fetch_q = queue.Queue(maxsize=QUEUE_SIZE)
+    save_q = queue.Queue(maxsize=QUEUE_SIZE)
+    slots = threading.Semaphore(QUEUE_SIZE)
+    stop = threading.Event()
+    records = {}
+    
+    fetch_pool = ThreadPoolExecutor(max_workers=FETCH_WORKERS)
+    save_pool = ThreadPoolExecutor(max_workers=SAVE_WORKERS)
+    for _ in range(SAVE_WORKERS):
+        save_pool.submit(_save_worker, save_q, records, output_folder)
+    producer = threading.Thread(target=_produce, daemon=True,
+                                args=(rows, fetch_pool, fetch_q, slots, stop, buffer_sqft_primary))
+    producer.start()
+    
+    expected = None  # Number of rows, known once the producer is done
+    read_error = None
+    received = 0
+    awaiting_secondary = {}  # pos -> primary (img, metadata, radius_m, detections, qc)
+    
+    try:
+        while expected is None or received < expected or awaiting_secondary:
+            # Block for one item, then drain whatever else is ready into the batch
+            batch = [fetch_q.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(fetch_q.get_nowait())
+                except queue.Empty:
+                    break
+            
+            ready = []
+            for kind, pos, sample_id, lat, lon, fetched, error in batch:
+                if kind == "done":
+                    expected = pos
+                    read_error = error
+                    continue
+                primary = None
+                if kind == "primary":
+                    received += 1
+                    slots.release()
+                    progress = f"{pos+1}/{total}" if total else f"{pos+1}"
+                    print(f"[{progress}] Processing: {sample_id} ({lat:.4f}, {lon:.4f})")
+                else:
+                    primary = awaiting_secondary.pop(pos)
+                if error is not None:
+                    print(f"  ERROR: {error}")
+                    records[pos] = _error_record(sample_id, lat, lon, error)
+                    continue
+                ready.append((kind, pos, sample_id, lat, lon, fetched, primary))
+            
+            if not ready:
+                continue
+            
+            try:
+                predictions = predict_on_pil_batch([item[5][0] for item in ready])
+            except Exception as e:
+                print(f"  ERROR: Batch inference failed: {e}")
+                for kind, pos, sample_id, lat, lon, *_ in ready:
+                    records[pos] = _error_record(sample_id, lat, lon, e)
+                continue
+            
+            for (kind, pos, sample_id, lat, lon, fetched, primary), (detections, raw) in zip(ready, predictions):
+                img, metadata, radius_m = fetched
+                if kind == "primary":
+                    needs_secondary, qc = _needs_secondary(img, detections)
+                    primary, secondary = (img, metadata, radius_m, detections, qc), None
+                    if needs_secondary:
+                        # Try secondary buffer; the row is saved once that image comes back
+                        awaiting_secondary[pos] = primary
+                        fetch_pool.submit(_fetch_job, fetch_q, stop, "secondary", pos, sample_id, lat, lon,
+                                          buffer_sqft_secondary)
+                        continue
+                else:
+                    secondary = (img, metadata, radius_m, detections, None)
+                chosen = _choose_result(primary, secondary, buffer_sqft_primary, buffer_sqft_secondary)
+                _put(save_q, (pos, sample_id, lat, lon, *chosen), stop)
+    finally:
+        stop.set()
+        for _ in range(SAVE_WORKERS):
+            save_q.put(None)
+        save_pool.shutdown(wait=True)
+        fetch_pool.shutdown(wait=True)
+    
+    if read_error is not None:
+        raise RuntimeError(f"Stopped reading rows after {expected}: {read_error}") from read_error
+    return [records[pos] for pos in sorted(records)]
+
+def _iter_csv_rows(csv_path, lat_col, lon_col):
+    """Yield (sample_id, lat, lon) from a CSV, parsing CSV_CHUNK_ROWS rows at a time."""
+    import pandas as pd
+    
+    # No explicit dtypes, so values are parsed the same way as a full pd.read_csv
+    chunks = pd.read_csv(csv_path, chunksize=CSV_CHUNK_ROWS, memory_map=True,
+                         usecols=["sample_id", lat_col, lon_col])
+    for chunk in chunks:
+        yield from zip(chunk["sample_id"].to_numpy(), chunk[lat_col].to_numpy(), chunk[lon_col].to_numpy())
+
+def run_inference_on_excel(excel_path, model_path, output_folder, device="cpu"):
     """
     Run end-to-end inference on all rows in Excel/CSV file.
     Excel should have: sample_id, latitude (or lat), longitude (or lon)
+    device: "cpu" or a CUDA device such as "0"; GPU runs use FP16
     """
+    import pandas as pd  # Deferred so importing the package stays fast
+    
     os.makedirs(output_folder, exist_ok=True)
     
     print(f"Loading model from: {model_path}")
-    model = load_model(model_path)
+    model = load_model(model_path, device=device, batch=BATCH_SIZE)
     
     print(f"Reading file: {excel_path}")
     
+    streaming = False
     try:
         file_ext = Path(excel_path).suffix.lower()
         
         # Try different read methods based on file extension
-        if file_ext == '.csv':
+        if file_ext == '.csv' and os.path.getsize(excel_path) > STREAM_CSV_BYTES:
+            # Large CSV: read the header now and stream the rows into the pipeline
+            df = pd.read_csv(excel_path, nrows=0)
+            streaming = True
+        elif file_ext == '.csv':
             df = pd.read_csv(excel_path)
         elif file_ext in ['.xlsx', '.xls']:
             try:
@@ -109,7 +342,10 @@ def run_inference_on_excel(excel_path, model_path, output_folder):
             print(f"  Unknown extension '{file_ext}', attempting CSV read...")
             df = pd.read_csv(excel_path)
         
-        print(f"✓ Successfully loaded {len(df)} rows")
+        if streaming:
+            print(f"✓ Large CSV, streaming rows in chunks of {CSV_CHUNK_ROWS}")
+        else:
+            print(f"✓ Successfully loaded {len(df)} rows")
         
     except Exception as e:
         print(f"✗ ERROR: Could not read file {excel_path}")
@@ -130,28 +366,21 @@ def run_inference_on_excel(excel_path, model_path, output_folder):
         print(f"  Expected: 'sample_id', and either 'latitude'/'longitude' or 'lat'/'lon'")
         return None
     
-    results = []
-    for idx, row in df.iterrows():
-        sample_id = row["sample_id"]
-        lat = row[lat_col]
-        lon = row[lon_col]
-        print(f"[{idx+1}/{len(df)}] Processing: {sample_id} ({lat:.4f}, {lon:.4f})")
-        
-        try:
-            rec = process_row(sample_id, lat, lon, model, output_folder)
-            results.append(rec)
-        except Exception as e:
-            print(f"  ERROR: {e}")
-            results.append({
-                "sample_id": int(sample_id),
-                "lat": float(lat),
-                "lon": float(lon),
-                "error": str(e)
-            })
+    if streaming:
+        rows, total = _iter_csv_rows(excel_path, lat_col, lon_col), None
+    else:
+        rows, total = zip(df["sample_id"].to_numpy(), df[lat_col].to_numpy(), df[lon_col].to_numpy()), len(df)
+    try:
+        results = run_pipeline(rows, output_folder, total=total)
+    except RuntimeError as e:
+        print(f"✗ ERROR: Could not read all rows of {excel_path}")
+        print(f"  Details: {e}")
+        return None
+    
+    prune_tile_cache()
     
     # Save aggregated results
-    with open(os.path.join(output_folder, "predictions.json"), "w") as f:
-        json.dump(results, f, indent=2)
+    write_json(os.path.join(output_folder, "predictions.json"), results)
     
     print(f"\nAll done! Outputs in: {output_folder}")
     return results
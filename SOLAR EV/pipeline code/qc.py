@@ -1,21 +1,38 @@
 from PIL import ImageStat, Image
 import numpy as np
 
+# Pixel statistics are computed on every Nth pixel per side
+QC_SAMPLE_STEP = 4
+
+def gray_histogram(image_pil, step=1):
+    """
+    Histogram of grayscale pixel values (256 bins), shared by the QC checks.
+    step > 1 samples every step-th pixel in each direction; unlike averaging, this
+    keeps the pixel value distribution that the cloud/shadow fractions depend on.
+    """
+    gray = np.asarray(image_pil.convert('L'), dtype=np.uint8)[::step, ::step]
+    return np.bincount(gray.ravel(), minlength=256)
+
 def resolution_check(image_pil, min_pixels=300):
     """Check if image has minimum resolution."""
     w, h = image_pil.size
     return (w >= min_pixels and h >= min_pixels)
 
-def brightness_check(image_pil, min_brightness=20):
+def brightness_check(image_pil, min_brightness=20, hist=None):
     """Check if image has minimum brightness (not too dark)."""
-    stat = ImageStat.Stat(image_pil.convert('L'))
-    return stat.mean[0] >= min_brightness
+    if hist is None:
+        stat = ImageStat.Stat(image_pil.convert('L'))
+        return stat.mean[0] >= min_brightness
+    mean = (np.arange(256) * hist).sum() / hist.sum()
+    return mean >= min_brightness
 
-def cloud_shadow_check(image_pil, shadow_threshold=40, cloud_threshold=220):
+def cloud_shadow_check(image_pil, shadow_threshold=40, cloud_threshold=220, hist=None):
     """Check for excessive cloud/shadow coverage."""
-    im = np.array(image_pil.convert('L'))
-    bright_frac = (im > cloud_threshold).sum() / im.size
-    dark_frac = (im < shadow_threshold).sum() / im.size
+    if hist is None:
+        hist = gray_histogram(image_pil)  # Single pass instead of one comparison per threshold
+    total = hist.sum()
+    bright_frac = hist[cloud_threshold + 1:].sum() / total
+    dark_frac = hist[:shadow_threshold].sum() / total
     if bright_frac > 0.4 or dark_frac > 0.4:
         return False
     return True
@@ -24,12 +41,15 @@ def qc_decision(image_pil, detections):
     """
     Returns: qc_status ('VERIFIABLE' or 'NOT_VERIFIABLE'), reasons list
     """
+    # Brightness and cloud/shadow only need coarse statistics, so sample a subset of pixels
+    step = QC_SAMPLE_STEP if min(image_pil.size) >= 256 else 1
+    hist = gray_histogram(image_pil, step)  # One grayscale pass feeds every pixel check
     reasons = []
     if not resolution_check(image_pil):
         reasons.append("low_resolution")
-    if not brightness_check(image_pil):
+    if not brightness_check(image_pil, hist=hist):
         reasons.append("low_brightness")
-    if not cloud_shadow_check(image_pil):
+    if not cloud_shadow_check(image_pil, hist=hist):
         reasons.append("cloud_or_shadow")
     if not detections:
         reasons.append("no_detection")
@@ -1,14 +1,86 @@
+import functools
 import numpy as np
 from PIL import Image
 
+# Squared distance from the centre column/row of a 640 px image (the pipeline's fixed size)
+_DX2_640 = (np.arange(640, dtype=np.int32) - 320)**2
+
 def pixels_to_m2(num_pixels, meters_per_pixel):
     """Convert pixel count to square meters."""
     return num_pixels * (meters_per_pixel ** 2)
 
+@functools.lru_cache(maxsize=8)
+def _buffer_circle(h, w, radius_px):
+    """
+    Boolean mask of the buffer circle centred on an h x w image.
+    Cached and read-only since every row uses the same image size and buffers.
+    """
+    if h == w == 640:
+        circle = _DX2_640[:, None] + _DX2_640[None, :] <= (radius_px**2)
+    else:
+        cx, cy = w // 2, h // 2
+        yy, xx = np.ogrid[:h, :w]
+        circle = (xx - cx)**2 + (yy - cy)**2 <= (radius_px**2)
+    circle.setflags(write=False)
+    return circle
+
+@functools.lru_cache(maxsize=8)
+def _buffer_circle_tensor(h, w, radius_px, device):
+    """Same as _buffer_circle, built directly on the given torch device."""
+    import torch
+    yy = torch.arange(h, device=device)[:, None]
+    xx = torch.arange(w, device=device)[None, :]
+    return (xx - w // 2)**2 + (yy - h // 2)**2 <= (radius_px**2)
+
+def _is_tensor(mask):
+    """True for torch tensors (masks straight from predict_on_pil)."""
+    return mask is not None and not isinstance(mask, np.ndarray) and hasattr(mask, 'cpu')
+
+def _select_from_tensor_masks(masks, h, w, radius_px):
+    """
+    Rank torch masks by overlap with the buffer circle without leaving the device.
+    Returns: best_idx (None if nothing overlaps), mask_pixels, selected_mask (binary numpy)
+    """
+    import torch
+    import torch.nn.functional as F
+    
+    stacked = torch.stack(masks)
+    if tuple(stacked.shape[-2:]) != (h, w):
+        # nearest-exact samples the same pixels as PIL NEAREST and cv2 INTER_NEAREST_EXACT
+        stacked = F.interpolate(stacked[:, None].float(), size=(h, w), mode='nearest-exact')[:, 0]
+    m = stacked != 0
+    
+    circle = _buffer_circle_tensor(h, w, radius_px, m.device)
+    overlaps = torch.logical_and(m, circle).sum(dim=(1, 2))
+    best_idx = int(torch.argmax(overlaps))
+    if overlaps[best_idx].item() <= 0:
+        return None, 0, None
+    
+    mask_pixels = m[best_idx].sum().item()
+    return best_idx, mask_pixels, m[best_idx].cpu().numpy()
+
+def _resize_mask(mask, h, w):
+    """Binarize a numpy mask and upsample it to h x w with nearest-neighbour."""
+    if mask.shape == (h, w):
+        return mask.astype(bool)
+    m_u8 = (mask != 0).astype(np.uint8)
+    try:
+        import cv2  # Imported here so loading the pipeline does not pull in OpenCV
+    except ImportError:  # Fall back to PIL for mask resizing
+        cv2 = None
+    if cv2 is not None:
+        # INTER_NEAREST_EXACT samples the same pixels as PIL's NEAREST
+        interpolation = getattr(cv2, 'INTER_NEAREST_EXACT', cv2.INTER_NEAREST)
+        m_u8 = cv2.resize(m_u8, (w, h), interpolation=interpolation)
+    else:
+        m_u8 = np.array(Image.fromarray(m_u8).resize((w, h), resample=Image.NEAREST))
+    return m_u8.astype(bool)
+
 def compute_selected_panel_area(detections, image_size_px, radius_m, selected_index=0):
     """
     Compute solar panel area using best detection with buffer zone.
-    Returns: area_m2, mask_pixels, selected_mask (binary numpy)
+    Returns: area_m2, mask_pixels, selected_mask (binary numpy, or an
+             (x1, y1, x2, y2) rectangle when the best detection has no mask)
     """
     w, h = image_size_px
     meters_per_pixel = (2 * radius_m) / w
@@ -18,28 +90,37 @@ def compute_selected_panel_area(detections, image_size_px, radius_m, selected_in
     mask_pixels = 0
     selected_mask = None
     
-    cx, cy = w // 2, h // 2
+    radius_px = int((radius_m * 1.0) / meters_per_pixel)
+    
+    masks = [d.get("mask", None) for d in detections]
+    if masks and all(_is_tensor(mask) for mask in masks):
+        best_idx, mask_pixels, selected_mask = _select_from_tensor_masks(masks, h, w, radius_px)
+        if best_idx is None:
+            return 0.0, 0, None
+        return pixels_to_m2(mask_pixels, meters_per_pixel), mask_pixels, selected_mask
+    
+    circle = _buffer_circle(h, w, radius_px)
     
     for idx, d in enumerate(detections):
         mask = d.get("mask", None)
         
         if mask is None:
-            # Use bounding box as fallback
+            # Use bounding box as fallback; the box is never rasterized, only the circle is sliced
             x1, y1, x2, y2 = map(int, d["box"])
-            m = np.zeros((h, w), dtype=bool)
             x1c, x2c = max(0, x1), min(w-1, x2)
             y1c, y2c = max(0, y1), min(h-1, y2)
-            m[y1c:y2c, x1c:x2c] = True
-        else:
-            m = mask.astype(bool)
-            if m.shape != (h, w):
-                mm = Image.fromarray(m.astype('uint8')*255).resize((w, h), resample=Image.NEAREST)
-                m = (np.array(mm) > 0)
+            region = circle[y1c:y2c, x1c:x2c]
+            overlap = region.sum()
+            if overlap > best_overlap:
+                best_overlap = overlap
+                best_idx = idx
+                mask_pixels = region.size
+                selected_mask = (x1c, y1c, x2c, y2c)
+            continue
         
-        # Compute buffer circle
-        yy, xx = np.ogrid[:h, :w]
-        radius_px = int((radius_m * 1.0) / meters_per_pixel)
-        circle = (xx - cx)**2 + (yy - cy)**2 <= (radius_px**2)
+        if _is_tensor(mask):
+            mask = mask.cpu().numpy()
+        m = _resize_mask(mask, h, w)
         overlap = np.logical_and(m, circle).sum()
         
         if overlap > best_overlap:
@@ -1,9 +1,33 @@
+import bisect
+import functools
 import math
 import os
 import io
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from PIL import Image, ImageDraw, ImageFont
 import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:  # Fall back to the standard library encoder
+    orjson = None
+
+TILE_HEADERS = {'User-Agent': 'Mozilla/5.0 Solar-PV-Detection/1.0'}
+
+# Shared session so tile requests reuse pooled keep-alive connections
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=32,
+                                      max_retries=Retry(total=2, backoff_factor=0.3)))
+
+# On-disk tile cache laid out as {provider}/{z}/{x}/{y}.tile; set SOLAR_PV_TILE_CACHE="" to disable
+TILE_CACHE_DIR = os.environ.get("SOLAR_PV_TILE_CACHE",
+                                os.path.join(os.path.expanduser("~"), ".cache", "solar_pv", "tiles"))
+TILE_CACHE_MAX_BYTES = 1024 * 1024 * 1024  # 1 GB, enforced by prune_tile_cache
 
 def sqft_to_radius_meters(sqft):
     """Convert area in sqft to equivalent circle radius in meters."""
@@ -11,13 +35,34 @@ def sqft_to_radius_meters(sqft):
     radius_m = radius_feet * 0.3048
     return radius_m
 
+@functools.lru_cache(maxsize=32)
+def _zoom_breakpoints(meters_per_pixel):
+    """
+    Precompute zoom(lat) = round(log2(156543.03392 * cos(lat) / meters_per_pixel)).
+    The rounded zoom only steps down at a handful of latitudes, so for each buffer size
+    (the pipeline uses two) this table turns the per-row log2/cos into a bisect.
+    Returns: (zoom at the equator, ascending |lat| values where zoom drops by one)
+    """
+    base = 156543.03392 / meters_per_pixel
+    top = int(round(math.log2(base)))
+    breaks = [math.degrees(math.acos(min(1.0, 2 ** (z - 0.5) / base))) for z in range(top, 0, -1)]
+    return top, breaks
+
 def latlon_to_zoom_for_width(lat_deg, target_ground_width_m, image_width_px=640):
     """Compute zoom level so that image_width_px covers target_ground_width_m at given latitude."""
-    meters_per_pixel = target_ground_width_m / image_width_px
-    zoom = math.log2((156543.03392 * math.cos(math.radians(lat_deg))) / meters_per_pixel)
-    zoom = max(0, min(18, int(round(zoom))))
+    top, breaks = _zoom_breakpoints(target_ground_width_m / image_width_px)
+    zoom = top - bisect.bisect_right(breaks, abs(lat_deg))
+    zoom = max(0, min(18, zoom))
     return zoom
 
+def latlon_to_tile_fraction(lat, lon, zoom):
+    """Web Mercator tile coordinates of lat/lon at zoom; the integer part is the tile index."""
+    n = 2 ** zoom
+    lat_rad = math.radians(lat)
+    x = ((lon + 180) / 360) * n
+    y = ((1 - math.log(math.tan(lat_rad) + 1/math.cos(lat_rad)) / math.pi) / 2) * n
+    return x, y
+
 def is_no_data_tile(img):
     """
     Detect if a tile is a 'Map data not yet available' placeholder.
@@ -27,16 +72,22 @@ def is_no_data_tile(img):
         return True
     
     # Convert to numpy array
-    arr = np.array(img)
+    arr = np.asarray(img)
     
     # Check if the image is mostly a single gray color (placeholder)
     # Esri placeholder tiles are typically RGB(200, 200, 200) or similar gray
     if arr.ndim == 3:
+        # Fast path: a sparse grid of pixels is enough to reject most real imagery.
+        # Only trust it when the colour is clearly away from the placeholder gray.
+        sample = arr[::40, ::40].reshape(-1, arr.shape[2]).astype(np.float32)
+        if np.var(sample) > 500 and np.any(np.abs(sample.mean(axis=0) - 200) >= 40):
+            return False
+        
         # Calculate color variance - real satellite images have high variance
         variance = np.var(arr)
         
         # Check if mostly gray (low variance and gray-ish mean)
-        mean_color = np.mean(arr, axis=(0, 1))
+        mean_color = arr.reshape(-1, arr.shape[2]).mean(axis=0)
         is_gray = np.std(mean_color) < 10  # R, G, B are very similar
         is_uniform = variance < 500  # Very low pixel variance
         
@@ -48,6 +99,95 @@ def is_no_data_tile(img):
     
     return False
 
+def _get_tile_cached(provider, z, x, y, url):
+    """
+    Return tile (provider, z, x, y) as a PIL image, downloading it only on a cache miss.
+    Cache writes are atomic (tmp file + rename) so concurrent workers never see partial tiles.
+    """
+    path = os.path.join(TILE_CACHE_DIR, provider, str(z), str(x), f"{y}.tile") if TILE_CACHE_DIR else None
+    
+    if path and os.path.exists(path):
+        try:
+            with open(path, "rb") as f:
+                tile_img = Image.open(io.BytesIO(f.read())).convert('RGB')
+            os.utime(path)  # Mark as recently used for prune_tile_cache
+            return tile_img
+        except Exception as e:
+            print(f"[WARNING] Ignoring unreadable cached tile {path}: {e}")
+    
+    resp = SESSION.get(url, timeout=15, headers=TILE_HEADERS)
+    resp.raise_for_status()
+    tile_img = Image.open(io.BytesIO(resp.content)).convert('RGB')
+    
+    if path:
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                f.write(resp.content)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"[WARNING] Could not cache tile {path}: {e}")
+    
+    return tile_img
+
+def prune_tile_cache(max_bytes=TILE_CACHE_MAX_BYTES):
+    """Delete least recently used cached tiles until the cache fits in max_bytes."""
+    if not TILE_CACHE_DIR or not os.path.isdir(TILE_CACHE_DIR):
+        return
+    
+    entries = []
+    total = 0
+    for root, _, files in os.walk(TILE_CACHE_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+    
+    entries.sort()
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+def iter_tiles(tasks, provider, zoom, max_workers=9):
+    """
+    Download tiles concurrently (through the disk cache), yielding them as they complete.
+    tasks: list of (dx, dy, tile_x, tile_y, url)
+    Yields: (task, PIL.Image or None, exception or None)
+    """
+    if not tasks:
+        return
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        futures = {ex.submit(_get_tile_cached, provider, zoom, task[2], task[3], task[4]): task for task in tasks}
+        for fut in as_completed(futures):
+            try:
+                yield futures[fut], fut.result(), None
+            except Exception as e:
+                yield futures[fut], None, e
+
+def paste_tile(canvas_np, tile_img, dx, dy, tile_size=256):
+    """
+    Copy a tile into the 3x3 numpy canvas at grid offset (dx, dy) in [-1, 1].
+    Returns the tile as a numpy array.
+    """
+    tile_np = np.asarray(tile_img)
+    if tile_np.shape[:2] != (tile_size, tile_size):  # Tile servers normally return 256x256 already
+        tile_np = np.asarray(tile_img.resize((tile_size, tile_size)))
+    paste_x = (dx + 1) * tile_size
+    paste_y = (dy + 1) * tile_size
+    canvas_np[paste_y:paste_y + tile_size, paste_x:paste_x + tile_size] = tile_np
+    return tile_np
+
 def download_maptiler_static_sat(lat, lon, radius_m, api_key, size=640, scale=2, maptype="satellite"):
     """
     Download satellite image using multiple providers with fallback.
@@ -111,7 +251,7 @@ def download_google_static_maps(lat, lon, zoom, size, api_key):
         "key": api_key
     }
     
-    resp = requests.get(url, params=params, timeout=15)
+    resp = SESSION.get(url, params=params, timeout=15)
     resp.raise_for_status()
     
     img = Image.open(io.BytesIO(resp.content)).convert('RGB')
@@ -123,12 +263,6 @@ def download_bing_aerial(lat, lon, zoom, size=640):
     """
     Download aerial imagery from Bing Maps using quadkey tiles.
     """
-    def latlon_to_tile(lat, lon, zoom):
-        n = 2 ** zoom
-        x = int(((lon + 180) / 360) * n)
-        y = int(((1 - math.log(math.tan(math.radians(lat)) + 1/math.cos(math.radians(lat))) / math.pi) / 2) * n)
-        return x, y
-    
     def tile_to_quadkey(x, y, zoom):
         quadkey = ""
         for i in range(zoom, 0, -1):
@@ -141,23 +275,18 @@ def download_bing_aerial(lat, lon, zoom, size=640):
             quadkey += str(digit)
         return quadkey
     
-    def latlon_to_tile_fraction(lat, lon, zoom):
-        n = 2 ** zoom
-        x = ((lon + 180) / 360) * n
-        y = ((1 - math.log(math.tan(math.radians(lat)) + 1/math.cos(math.radians(lat))) / math.pi) / 2) * n
-        return x, y
-    
     zoom = min(zoom, 19)
-    center_x, center_y = latlon_to_tile(lat, lon, zoom)
+    # Convert lat/lon to tile coordinates
     frac_x, frac_y = latlon_to_tile_fraction(lat, lon, zoom)
+    center_x, center_y = int(frac_x), int(frac_y)
     
     offset_x = int((frac_x - center_x) * 256)
     offset_y = int((frac_y - center_y) * 256)
     
     tile_size = 256
-    canvas = Image.new('RGB', (768, 768), color=(200, 200, 200))
+    canvas_np = np.full((768, 768, 3), 200, dtype=np.uint8)
     
-    tiles_downloaded = 0
+    tasks = []
     for dx in range(-1, 2):
         for dy in range(-1, 2):
             tile_x = center_x + dx
@@ -170,18 +299,15 @@ def download_bing_aerial(lat, lon, zoom, size=640):
             quadkey = tile_to_quadkey(tile_x, tile_y, zoom)
             # Bing Maps aerial tile URL
             url = f"https://ecn.t0.tiles.virtualearth.net/tiles/a{quadkey}.jpeg?g=1"
-            
-            try:
-                resp = requests.get(url, timeout=15, headers={'User-Agent': 'Mozilla/5.0 Solar-PV-Detection/1.0'})
-                resp.raise_for_status()
-                tile_img = Image.open(io.BytesIO(resp.content)).convert('RGB')
-                tile_img = tile_img.resize((tile_size, tile_size))
-                paste_x = (dx + 1) * tile_size
-                paste_y = (dy + 1) * tile_size
-                canvas.paste(tile_img, (paste_x, paste_y))
-                tiles_downloaded += 1
-            except Exception as e:
-                print(f"[WARNING] Failed to download Bing tile: {e}")
+            tasks.append((dx, dy, tile_x, tile_y, url))
+    
+    tiles_downloaded = 0
+    for (dx, dy, tile_x, tile_y, url), tile_img, error in iter_tiles(tasks, "bing_aerial", zoom):
+        if error is not None:
+            print(f"[WARNING] Failed to download Bing tile: {error}")
+            continue
+        paste_tile(canvas_np, tile_img, dx, dy, tile_size)
+        tiles_downloaded += 1
     
     if tiles_downloaded == 0:
         raise Exception("Failed to download any Bing tiles")
@@ -192,7 +318,7 @@ def download_bing_aerial(lat, lon, zoom, size=640):
     left = max(0, min(center_px - size // 2, 768 - size))
     top = max(0, min(center_py - size // 2, 768 - size))
     
-    img = canvas.crop((left, top, left + size, top + size))
+    img = Image.fromarray(canvas_np[top:top + size, left:left + size])
     return img
 
 def download_osm_esri_tiles(lat, lon, zoom, size=640):
@@ -201,31 +327,17 @@ def download_osm_esri_tiles(lat, lon, zoom, size=640):
     Tiles 256x256, we'll stitch multiple to cover the requested area.
     """
     # Convert lat/lon to tile coordinates
-    def latlon_to_tile(lat, lon, zoom):
-        n = 2 ** zoom
-        x = ((lon + 180) / 360) * n
-        y = ((1 - math.log(math.tan(math.radians(lat)) + 1/math.cos(math.radians(lat))) / math.pi) / 2) * n
-        return int(x), int(y)
-    
-    def latlon_to_tile_fraction(lat, lon, zoom):
-        n = 2 ** zoom
-        x = ((lon + 180) / 360) * n
-        y = ((1 - math.log(math.tan(math.radians(lat)) + 1/math.cos(math.radians(lat))) / math.pi) / 2) * n
-        return x, y
-    
-    center_x, center_y = latlon_to_tile(lat, lon, zoom)
     frac_x, frac_y = latlon_to_tile_fraction(lat, lon, zoom)
+    center_x, center_y = int(frac_x), int(frac_y)
     
     offset_x = int((frac_x - center_x) * 256)
     offset_y = int((frac_y - center_y) * 256)
     
     # Download 3x3 tiles centered on location for better coverage
     tile_size = 256
-    canvas = Image.new('RGB', (768, 768), color=(200, 200, 200))  # Gray fallback
-    
-    tiles_downloaded = 0
-    valid_tiles = 0  # Track tiles that aren't placeholders
+    canvas_np = np.full((768, 768, 3), 200, dtype=np.uint8)  # Gray fallback
     
+    tasks = []
     for dx in range(-1, 2):
         for dy in range(-1, 2):
             tile_x = center_x + dx
@@ -238,22 +350,20 @@ def download_osm_esri_tiles(lat, lon, zoom, size=640):
             
             # Esri World Imagery URL
             url = f"https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{zoom}/{tile_y}/{tile_x}"
-            
-            try:
-                resp = requests.get(url, timeout=15, headers={'User-Agent': 'Mozilla/5.0 Solar-PV-Detection/1.0'})
-                resp.raise_for_status()
-                tile_img = Image.open(io.BytesIO(resp.content)).convert('RGB')
-                tile_img = tile_img.resize((tile_size, tile_size))
-                paste_x = (dx + 1) * tile_size
-                paste_y = (dy + 1) * tile_size
-                canvas.paste(tile_img, (paste_x, paste_y))
-                tiles_downloaded += 1
-                
-                if not is_no_data_tile(tile_img):
-                    valid_tiles += 1
-                    
-            except Exception as e:
-                print(f"[WARNING] Failed to download tile {zoom}/{tile_y}/{tile_x}: {e}")
+            tasks.append((dx, dy, tile_x, tile_y, url))
+    
+    tiles_downloaded = 0
+    valid_tiles = 0  # Track tiles that aren't placeholders
+    
+    for (dx, dy, tile_x, tile_y, url), tile_img, error in iter_tiles(tasks, "esri_world_imagery", zoom):
+        if error is not None:
+            print(f"[WARNING] Failed to download tile {zoom}/{tile_y}/{tile_x}: {error}")
+            continue
+        tile_np = paste_tile(canvas_np, tile_img, dx, dy, tile_size)
+        tiles_downloaded += 1
+        
+        if not is_no_data_tile(tile_np):
+            valid_tiles += 1
     
     if tiles_downloaded == 0:
         raise Exception("Failed to download any tiles")
@@ -275,7 +385,7 @@ def download_osm_esri_tiles(lat, lon, zoom, size=640):
     right = left + size
     bottom = top + size
     
-    img = canvas.crop((left, top, right, bottom))
+    img = Image.fromarray(canvas_np[top:bottom, left:right])
     
     print(f"[INFO] Created {size}x{size} image from {tiles_downloaded} tiles ({valid_tiles} valid) at zoom {zoom}")
     return img
@@ -285,28 +395,17 @@ def download_osm_standard_map(lat, lon, zoom, size=640):
     Fallback: OpenStreetMap standard map tiles (free).
     Less detailed than satellite but always available.
     """
-    def latlon_to_tile(lat, lon, zoom):
-        n = 2 ** zoom
-        x = ((lon + 180) / 360) * n
-        y = ((1 - math.log(math.tan(math.radians(lat)) + 1/math.cos(math.radians(lat))) / math.pi) / 2) * n
-        return int(x), int(y)
-    
-    def latlon_to_tile_fraction(lat, lon, zoom):
-        n = 2 ** zoom
-        x = ((lon + 180) / 360) * n
-        y = ((1 - math.log(math.tan(math.radians(lat)) + 1/math.cos(math.radians(lat))) / math.pi) / 2) * n
-        return x, y
-    
-    center_x, center_y = latlon_to_tile(lat, lon, zoom)
+    # Convert lat/lon to tile coordinates
     frac_x, frac_y = latlon_to_tile_fraction(lat, lon, zoom)
+    center_x, center_y = int(frac_x), int(frac_y)
     
     offset_x = int((frac_x - center_x) * 256)
     offset_y = int((frac_y - center_y) * 256)
     
     tile_size = 256
-    canvas = Image.new('RGB', (768, 768), color=(200, 200, 200))
+    canvas_np = np.full((768, 768, 3), 200, dtype=np.uint8)
     
-    tiles_downloaded = 0
+    tasks = []
     for dx in range(-1, 2):
         for dy in range(-1, 2):
             tile_x = center_x + dx
@@ -319,18 +418,15 @@ def download_osm_standard_map(lat, lon, zoom, size=640):
             
             # OpenStreetMap tile server (note: OSM uses /z/x/y format)
             url = f"https://tile.openstreetmap.org/{zoom}/{tile_x}/{tile_y}.png"
-            
-            try:
-                resp = requests.get(url, timeout=15, headers={'User-Agent': 'Mozilla/5.0 Solar-PV-Detection/1.0'})
-                resp.raise_for_status()
-                tile_img = Image.open(io.BytesIO(resp.content)).convert('RGB')
-                tile_img = tile_img.resize((tile_size, tile_size))
-                paste_x = (dx + 1) * tile_size
-                paste_y = (dy + 1) * tile_size
-                canvas.paste(tile_img, (paste_x, paste_y))
-                tiles_downloaded += 1
-            except Exception as e:
-                print(f"[WARNING] Failed to download OSM tile {zoom}/{tile_x}/{tile_y}: {e}")
+            tasks.append((dx, dy, tile_x, tile_y, url))
+    
+    tiles_downloaded = 0
+    for (dx, dy, tile_x, tile_y, url), tile_img, error in iter_tiles(tasks, "osm_standard", zoom):
+        if error is not None:
+            print(f"[WARNING] Failed to download OSM tile {zoom}/{tile_x}/{tile_y}: {error}")
+            continue
+        paste_tile(canvas_np, tile_img, dx, dy, tile_size)
+        tiles_downloaded += 1
     
     if tiles_downloaded == 0:
         raise Exception("Failed to download OSM tiles")
@@ -341,7 +437,7 @@ def download_osm_standard_map(lat, lon, zoom, size=640):
     left = max(0, min(center_px - size // 2, 768 - size))
     top = max(0, min(center_py - size // 2, 768 - size))
     
-    img = canvas.crop((left, top, left + size, top + size))
+    img = Image.fromarray(canvas_np[top:top + size, left:left + size])
     
     return img
 
@@ -354,7 +450,7 @@ def save_overlay(image_pil, masks=None, boxes=None, buffer_radius_px=None, out_p
     """
     Save overlay with masks, boxes, and buffer circle.
     image_pil: PIL.Image
-    masks: list of binary numpy arrays
+    masks: list of binary numpy arrays or torch tensors
     boxes: list of (x1,y1,x2,y2)
     buffer_radius_px: int (draw circle at center)
     """
@@ -373,6 +469,8 @@ def save_overlay(image_pil, masks=None, boxes=None, buffer_radius_px=None, out_p
         for mask in masks:
             if mask is None:
                 continue
+            if hasattr(mask, 'cpu'):
+                mask = mask.cpu().numpy()  # torch tensor from predict_on_pil
             mask_img = Image.fromarray((mask.astype('uint8')*150).astype('uint8')).convert('L').resize(im.size)
             colored = Image.new("RGBA", im.size, (0,255,0,80))
             im.paste(colored, (0,0), mask_img)
@@ -384,3 +482,12 @@ def save_overlay(image_pil, masks=None, boxes=None, buffer_radius_px=None, out_p
     
     im.save(out_path)
     return out_path
+
+def write_json(path, obj):
+    """Write obj as indented JSON, using orjson when it is installed."""
+    if orjson is not None:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+    else:
+        with open(path, "w") as f:
+            json.dump(obj, f, indent=2)